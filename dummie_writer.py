@@ -37,38 +37,39 @@ def write_dummies(data_list, force, test):
 
 
 def try_to_write_dummy(data_set):
-    name = generate_name(data_set)
+    fields = mc.extract_all(data_set)
+    name = generate_name(fields)
     path = "data/output/xml/" + name + ".xml"
     if not force_all:
         if os.path.isfile(path):
-            print("File already exists: {}. Skipped sys no: {}".format(path, mc.get_system_number(data_set)))
+            print("File already exists: {}. Skipped sys no: {}".format(path.encode('utf-8'), mc.get_system_number(fields)))
             return
 
     try:
-        write_dummy(name, path, data_set)
+        write_dummy(name, path, fields)
     except Exception as e:
         print("\n\n\n\n!!!!!!!!!!!!!!!!!!!! Error !!!!!!!!!!!!!!!!!!!!!")
-        print("Error occured in: " + name)
+        print("Error occured in: " + name.encode('utf-8'))
         print(e)
         print(traceback.format_exc())
         quit(1)
 
 
-def write_dummy(name, path, data_set):
+def write_dummy(name, path, fields):
     if is_test:
-        print("Writing file: {}".format(path))
+        print("Writing file: {}".format(path.encode('utf-8')))
 
-    if mc.get_date(data_set) is None:
+    if mc.get_date(fields) is None:
         date_str = "0000.00.00"
     else:
-        date_str = unicode(mc.get_date(data_set), 'utf-8')
+        date_str = mc.get_date(fields)
 
     xml_string = unicode("", 'utf-8')
     xml_string = xml_string + "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
     xml_string = xml_string + "<letter xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\"\n"
     xml_string = xml_string + "        xsi:noNamespaceSchemaLocation=\"../Schema_and_DTD/letter.xsd\"\n"
-    xml_string = xml_string + "        title=\"" + unicode(name, 'utf-8') + "\"\n"
-    xml_string = xml_string + "        catalogue_id=\"" + unicode(mc.get_system_number(data_set), 'utf-8') + "\"\n"
+    xml_string = xml_string + "        title=\"" + name + "\"\n"
+    xml_string = xml_string + "        catalogue_id=\"" + mc.get_system_number(fields) + "\"\n"
     xml_string = xml_string + "        date=\"" + date_str + "\">\n"
     xml_string = xml_string + "   <metadata>\n"
 
@@ -79,21 +80,21 @@ def write_dummy(name, path, data_set):
     xml_string = xml_string + "   </metadata>\n"
     xml_string = xml_string + "   <persons>\n"
 
-    authors = mc.get_author(data_set)
+    authors = mc.get_author(fields)
     xml_string = xml_string + "      <author>\n"
-    xml_string = xml_string + unicode(get_person_xml_sting(authors), 'utf-8')
+    xml_string = xml_string + get_person_xml_sting(authors)
     xml_string = xml_string + "      </author>\n"
 
-    recip = mc.get_recipient(data_set)
+    recip = mc.get_recipient(fields)
     xml_string = xml_string + "      <recipient>\n"
-    xml_string = xml_string + unicode(get_person_xml_sting(recip), 'utf-8')
+    xml_string = xml_string + get_person_xml_sting(recip)
     xml_string = xml_string + "      </recipient>\n"
 
-    mentioned = mc.get_mentioned_persons(data_set)
+    mentioned = mc.get_mentioned_persons(fields)
     mentioned_str = get_person_xml_sting(mentioned)
     if mentioned_str != "":
         xml_string = xml_string + "      <mentioned>\n"
-        xml_string = xml_string + unicode(mentioned_str, 'utf-8')
+        xml_string = xml_string + mentioned_str
         xml_string = xml_string + "      </mentioned>\n"
 
     xml_string = xml_string + "   </persons>\n"
@@ -110,44 +111,44 @@ def get_person_xml_sting(persons_list):
     if persons_list is None:
         return ""
 
-    res = ""
+    res = u""
 
     for person in persons_list:
         if person is None:
-            res = res + "         <person/>\n"
+            res = res + u"         <person/>\n"
             continue
-        res = res + "         <person>\n"
-        res = res + "            <gnd>{}</gnd>\n".format(person['GND'])
-        res = res + "            <name>{}</name>\n".format(person['name'])
-        res = res + "            <date>{}</date>\n".format(person['date'])
-        res = res + "         </person>\n"
+        res = res + u"         <person>\n"
+        res = res + u"            <gnd>{}</gnd>\n".format(person['GND'])
+        res = res + u"            <name>{}</name>\n".format(person['name'])
+        res = res + u"            <date>{}</date>\n".format(person['date'])
+        res = res + u"         </person>\n"
 
     return res
 
 
 def write_to_file(path, data):
+    # the marc data is handled as unicode throughout; it only gets encoded here, when written to disk
     data_ascii = data.encode('utf-8')
-    path_u = path.decode('utf-8')
 
     if is_test:
         print("Writing to File...\nData:\n{}".format(data_ascii))
 
-    with codecs.open(path_u, "w", "utf-8") as f:
+    with codecs.open(path, "w", "utf-8") as f:
         f.write(data)
 
     print("Done Writing file.")
     return
 
 
-def generate_name(data_set):
+def generate_name(fields):
     # TODO handle unknown recipients? ... is "unbekannt" a solution?
 
-    date = mc.get_date(data_set)
+    date = mc.get_date(fields)
     if date is None:
         date = "0000-00-00"
     date = date.replace(".", "-")
 
-    authors = mc.get_author(data_set)
+    authors = mc.get_author(fields)
     if len(authors) == 0:
         author_name = "unbekannt"
     else:
@@ -157,7 +158,7 @@ def generate_name(data_set):
         author_name = author_name.replace("'", "")
         author_name = author_name.replace(",", "")
 
-    recipients = mc.get_recipient(data_set)
+    recipients = mc.get_recipient(fields)
     if len(recipients) == 0:
         rec_name = "unbekannt"
     else:
@@ -9,13 +9,55 @@ It is used for:
 
 from pymarc import MARCReader
 from PyZ3950 import zoom
+from multiprocessing.pool import ThreadPool
+from functools import partial
+import threading
+import cPickle as pickle
+import atexit
 import os
 import sys
 
 
-force_all = False
-is_test = False
-no_list = []
+# number of Z39.50 requests that are sent to aleph simultaneously
+max_connections = 16
+
+# progress counters are only updated every this many items, to save on writes to the console
+progress_interval = 50
+
+# number of fetched records, after which the queued cache files are written to disk
+cache_batch_size = 100
+
+# every thread keeps its own connection to aleph, which is reused for all of its requests
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+# parsed marc records, by system number
+_records = {}
+
+
+def __index_cache():
+    """
+    Lists the system numbers that have marc data in the cache.
+
+    :return: two sets of system numbers: those with a `.marc` file and those with a `.pkl` file in `data/tmp/marc`
+    """
+
+    marc_nos = set()
+    pickled_nos = set()
+    if os.path.isdir("data/tmp/marc"):
+        for f in os.listdir("data/tmp/marc"):
+            no, ext = os.path.splitext(f)
+            if ext == ".marc":
+                marc_nos.add(no)
+            elif ext == ".pkl":
+                pickled_nos.add(no)
+    return marc_nos, pickled_nos
+
+
+# system numbers, for which marc binaries and parsed records are cached;
+# the cache directory is read once, so looking up a number needs no further file system access
+_cached_nos, _pickled_nos = __index_cache()
 
 
 def get_info_from_aleph(nos, force, test):
@@ -30,126 +72,319 @@ def get_info_from_aleph(nos, force, test):
 
     print("Getting Meta Information from Aleph Catalogue...")
     print("Is Force Run: {}".format(force))
-    global force_all
-    force_all = force
     print("Is Test Run: {}".format(test))
-    global is_test
-    is_test = test
-    global no_list
-    no_list = nos
 
     res = []
 
-    if is_test:
-        res.append(test_mc())
+    try:
+        if test:
+            res.append(test_mc(nos))
+        else:
+            print("")
+            i = 1
+            max = len(nos) + 1
+            res = [None] * len(nos)
+            pool = ThreadPool(max_connections)
+            try:
+                # records are taken as soon as they arrive, so one slow request doesn't hold up the others;
+                # the index puts them back into the order of `nos`
+                for idx, mc in pool.imap_unordered(partial(__get_marc_at, force=force), enumerate(nos)):
+                    if i % progress_interval == 0 or i == len(nos):
+                        sys.stdout.write("\r{} of {} ({}%)".format(i, max, (100 * i / max)))
+                        sys.stdout.flush()
+                    i = i + 1
+                    res[idx] = mc
+                    if len(_cache_writer.pending) >= cache_batch_size:
+                        _cache_writer.flush()
+            except:
+                # don't keep fetching from aleph, when the run fails or is interrupted
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+    except:
+        # write what is left in the queue, also when the run has failed or was interrupted;
+        # but the error that stopped the run is the one to surface, not one from writing the cache
+        __flush_cache_after_error()
+        raise
     else:
-        print("")
-        i = 1
-        max = len(no_list) + 1
-        for no in no_list:
-            sys.stdout.write("\r{} of {} ({}%)".format(i, max, (100 * i / max)))
-            sys.stdout.flush()
-            i = i + 1
-            res.append(get_marc(no))
+        _cache_writer.flush()
 
     print("\n\nDone getting Meta Info.\n")
     return res
 
 
-def get_marc(no):
+def __flush_cache_after_error():
+    # this needs to be a function of its own: otherwise, in python 2, handling an error from the flush
+    # would make the caller's `raise` re-raise that error instead of the original one
+    try:
+        _cache_writer.flush()
+    except (IOError, OSError) as e:
+        print("\n!!! Error: could not write to cache: {} !!!\n".format(e))
+
+
+def __get_marc_at(item, force):
+    idx, no = item
+    return idx, get_marc(no, force)
+
+
+def get_marc(no, force=False):
     """
     gets marc record for a single entry
 
     Convenience method that checks, if the marc record needs to be loaded (over read_mc()) or loaded from cache.
+    Records that have been loaded once are kept in memory, so they are not parsed again.
     :param no: system number
+    :param force: if true, the record is loaded from aleph, even if it is cached already.
     :return: marc record for the system number.
     """
 
 #    print("getting marc for: {}".format(no))
 
-    if force_all:
+    if force:
+        mc = read_mc(no, force)
+    elif no in _records:
+        return _records[no]
+    elif no in _cached_nos:
+        mc = __read_mc_from_cache(no)
+    else:
         mc = read_mc(no)
-        return mc
 
-    if os.path.isfile("data/tmp/marc/" + no + ".marc"):
-        return __read_mc_from_cache(no)
-
-    mc = read_mc(no)
+    if mc is not None:
+        _records[no] = mc
     return mc
 
 
 def __read_mc_from_cache(no):
-    with open("data/tmp/marc/" + no + ".marc", "rb") as f:
+    marc_path = "data/tmp/marc/" + no + ".marc"
+    pickle_path = "data/tmp/marc/" + no + ".pkl"
+
+    # CacheWriter writes the pickle and then the binary, both atomically, so the pickle never holds older data
+    # than the binary. This only holds for files written by this program: if a `.marc` file is replaced by hand,
+    # its `.pkl` has to be deleted as well.
+    if no in _pickled_nos:
+        try:
+            with open(pickle_path, "rb") as f:
+                return pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ImportError, AttributeError, ValueError):
+            # e.g. a truncated file, or one pickled with a different version of pymarc
+            print("Could not load pickled record: " + pickle_path + "\n")
+
+    with open(marc_path, "rb") as f:
         data = f.read()
-    reader = MARCReader(bytes(data), force_utf8=True, to_unicode=True)
+    reader = MARCReader(data, force_utf8=True, to_unicode=True)
     tmp = next(reader)
 #    print("loaded data from cache.")
+
+    _cache_writer.add(no, None, tmp)
     return tmp
 
 
-def __write_to_cache(marc, no):
-    if force_all or is_test or not os.path.isfile("data/tmp/marc/" + no + ".marc"):
-        with open("data/tmp/marc/" + no + ".marc", "wb") as f:
-            f.write(marc)
+def _write_atomic(path, data):
+    """
+    Writes data to a file, so that the file is either complete or not there at all.
+
+    The data is written to a temporary file first, which is then renamed to `path`.
+    :param path: path of the file
+    :param data: binary content of the file
+    """
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # on windows, rename() does not replace existing files
+        os.remove(path)
+        os.rename(tmp_path, path)
+
 
+def __write_to_cache(marc, record, no, force):
+    if force or no not in _cached_nos:
+        _cache_writer.add(no, marc, record)
 
-def test_mc():
+
+class CacheWriter(object):
+    """
+    Collects marc data for the cache in memory and writes it to `data/tmp/marc` in batches.
+
+    flush() is called from the main thread, so the worker threads don't need to wait for the disk
+    while fetching from aleph.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self._lock = threading.Lock()
+
+    def add(self, no, marc, record):
+        """
+        Queues marc data to be written to the cache on the next flush().
+
+        :param no: system number
+        :param marc: marc binary for the system number, or None if only the pickle is to be written
+        :param record: the parsed marc record, which is pickled next to the binary
+        """
+
+        with self._lock:
+            self.pending.append((no, marc, record))
+
+    def flush(self):
+        """
+        Writes all queued marc data to the cache.
+
+        If writing fails, the entries that have not been written are kept in the queue.
+        """
+
+        with self._lock:
+            pending = self.pending
+            self.pending = []
+
+        for i, (no, marc, record) in enumerate(pending):
+            try:
+                # the pickle goes first: if the binary is not written in the end, the pickle still holds the newer data
+                _write_atomic("data/tmp/marc/" + no + ".pkl", pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+                _pickled_nos.add(no)
+                if marc is not None:
+                    _write_atomic("data/tmp/marc/" + no + ".marc", marc)
+                    _cached_nos.add(no)
+            except:
+                with self._lock:
+                    self.pending[:0] = pending[i:]
+                raise
+
+
+# marc data loaded from aleph, waiting to be written to the cache
+_cache_writer = CacheWriter()
+
+
+def test_mc(nos):
     """
     Method for testing purpose. Loads a single record instead of the entire list.
 
+    :param nos: the list of system numbers to pick from
     :return: A random marc entry to one system number from the list.
     """
 
     import random
-    no = no_list[random.randint(0, len(no_list)-1)]
+    no = nos[random.randint(0, len(nos)-1)]
     print("Testing: {}".format(no))
-    mc = read_mc(no)
+    mc = read_mc(no, True)
     print("Marc Data:")
     print(mc)
 
     return mc
 
 
-def read_mc(sys_no):
+def read_mc(sys_no, force=False):
     """
     Loads marc data from aleph.unibas.ch for one single system number.
 
     :param sys_no: System number to which the marc entry is to be loaded.
-    :return: marc binary for said system number.
+    :param force: if true, an already cached entry is overwritten.
+    :return: marc record for said system number.
     """
 
 #    print("reading: "+sys_no)
 
+    query = zoom.Query('PQF', '@attr 1=1032 ' + sys_no)
     try:
-        conn = zoom.Connection('aleph.unibas.ch', 9909)
-        conn.databaseName = 'dsv05'
-        conn.preferredRecordSyntax = 'USMARC'
-
-        query = zoom.Query('PQF', '@attr 1=1032 ' + sys_no)
-        res = conn.search(query)
-        data = bytes(res[0].data)
+        try:
+            data = __fetch(__get_connection(), query)
+        except zoom.ConnectionError:
+            # the connection may have been dropped by aleph in the meantime; retry once with a new one
+            data = __fetch(__get_connection(reconnect=True), query)
     except zoom.ConnectionError:
         print("\n!!! Error: could not connect to aleph !!!\n")
         return
 
-    __write_to_cache(data, sys_no)
-
-    reader = MARCReader(bytes(data), force_utf8=True, to_unicode=True)
+    reader = MARCReader(data, force_utf8=True, to_unicode=True)
     tmp = next(reader)
 #    print("loaded data from aleph.")
+
+    # the parsed record is cached along with the binary, so it doesn't need to be parsed again
+    __write_to_cache(data, tmp, sys_no, force)
     return tmp
 
 
-def get_system_number(record):
+def __fetch(conn, query):
+    # both the search and reading the record send a request over the connection
+    res = conn.search(query)
+    return bytes(res[0].data)
+
+
+def __get_connection(reconnect=False):
+    """
+    Gets the connection to aleph.unibas.ch of the current thread.
+
+    The connection is opened on first use and then kept open for all further requests of the thread.
+    :param reconnect: if true, the existing connection is dropped and a new one is opened.
+    :return: Z39.50 connection to the aleph catalogue
+    """
+
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and not reconnect:
+        return conn
+
+    if conn is not None:
+        __close_connection(conn)
+        with _connections_lock:
+            _connections.remove(conn)
+        _local.conn = None
+
+    conn = zoom.Connection('aleph.unibas.ch', 9909)
+    conn.databaseName = 'dsv05'
+    conn.preferredRecordSyntax = 'USMARC'
+    _local.conn = conn
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+
+def __close_connection(conn):
+    try:
+        conn.close()
+    except Exception:
+        # the connection is of no use anymore anyway
+        pass
+
+
+@atexit.register
+def __close_all_connections():
+    with _connections_lock:
+        for conn in _connections:
+            __close_connection(conn)
+        del _connections[:]
+
+
+def extract_all(record):
+    """
+    Groups all fields of a marc record by their tag.
+
+    The get_* functions below work on this mapping, so the record's fields are only walked once,
+    no matter how many of them are called.
+    :param record: marc record
+    :return: a dict mapping each tag to the list of fields with that tag, in record order.
+    """
+
+    groups = {}
+    for field in record.get_fields():
+        groups.setdefault(field.tag, []).append(field)
+    return groups
+
+
+def get_system_number(groups):
     """
     Reads the system number from marc data
 
-    :param record: binary marc record
+    :param groups: fields of a marc record, as returned by extract_all()
     :return: system number as string
     """
 
-    field = record.get_fields('035')
-    no = field[0]['a'].encode('utf-8')
+    field = groups.get('035', [])
+    no = field[0]['a']
 
     return no
 
@@ -159,12 +394,24 @@ def get_system_number(record):
 # ( also: https://git.iml.unibas.ch/salsah-suite/api_import_scripts/blob/master/BEOL/BEBB/BEBBParser.py )
 
 
-def get_date(records):
-    date = None
-    for field in records.get_fields('046'):
-        date = field['c'].encode('utf-8')
+def __get_last_subfield(groups, tag, code):
+    """
+    Gets a subfield from the last field with the tag that has this subfield.
 
-    return date
+    :param groups: fields of a marc record, as returned by extract_all()
+    :param tag: tag of the field
+    :param code: code of the subfield
+    :return: value of the subfield, or None if no field has it
+    """
+
+    for field in reversed(groups.get(tag, [])):
+        if code in field:
+            return field[code]
+    return None
+
+
+def get_date(groups):
+    return __get_last_subfield(groups, '046', 'c')
 
 
 def __check_for_gnd(marcField, GNDIndex):
@@ -185,20 +432,20 @@ def __check_for_gnd(marcField, GNDIndex):
         role = marcField['4']
 
     return {
-        "GND": GND.encode('utf-8'),
-        "name": marcField['a'].encode('utf-8'),
-        "date": date.encode('utf-8'),
-        "role": role.encode('utf-8')
+        "GND": GND,
+        "name": marcField['a'],
+        "date": date,
+        "role": role
     }
 
 
-def get_author(records):
+def get_author(groups):
     author = []
-    for field in records.get_fields('100'):
+    for field in groups.get('100', []):
         author.append(__check_for_gnd(field, '0'))
 
     # check for 700 that are actually authors
-    for field in records.get_fields('700'):
+    for field in groups.get('700', []):
         person = __check_for_gnd(field, '0')
 
         if person['role'] == "aut":
@@ -207,9 +454,9 @@ def get_author(records):
     return author
 
 
-def get_recipient(records):
+def get_recipient(groups):
     recipient = []
-    for field in records.get_fields('700'):
+    for field in groups.get('700', []):
         person = __check_for_gnd(field, '0')
 
         if person['role'] == "rcp":
@@ -218,206 +465,93 @@ def get_recipient(records):
     return recipient
 
 
-def get_mentioned_persons(records):
+def get_mentioned_persons(groups):
     mentioned = []
-    for field in records.get_fields('600'):
+    for field in groups.get('600', []):
         mentioned.append(__check_for_gnd(field, '0'))
 
     return mentioned
 
 
-def get_description(records):
-    description = None
-    for field in records.get_fields('245'):
-        if 'a' in field:
-            description = {
-                'title': field['a'].encode('utf-8')
-            }
-
-        if 'c' in field:
-            if description is not None:
-                description.update({
-                    'author': field['c'].encode('utf-8')
-                })
-            else:
-                description = {
-                    'author': field['c'].encode('utf-8')
-                }
-
-    return description
-
-
-def get_creation_form(records):
-    creation_information = None
-    for field in records.get_fields('250'):
-        if 'a' in field:
-            creation_information = field['a'].encode('utf-8')
-
-    return creation_information
-
-
-def get_creation_place(records):
-    creation_place = None
-    for field in records.get_fields('751'):
-        if 'a' in field:
-            creation_place = {
-                'place': field['a'].encode('utf-8')
-            }
-        if '0' in field:
-            if creation_place is not None:
-                creation_place.update({
-                    'gnd': field['0'].encode('utf-8')
-                })
-            else:
-                creation_place = {
-                    'gnd': field['0'].encode('utf-8')
-                }
-
-    return creation_place
-
-
-def get_physical_description(records):
-    physical_description = None
-    for field in records.get_fields('300'):
-        if 'a' in field:
-            physical_description = {
-                'amount': field['a'].encode('utf-8')
-            }
-
-        if 'c' in field:
-            if physical_description is not None:
-                physical_description.update({
-                    'format': field['c'].encode('utf-8')
-                })
-            else:
-                physical_description = {
-                    'format': field['c'].encode('utf-8')
-                }
-
-    return physical_description
+def __get_subfield_dict(groups, tag, mapping):
+    """
+    Collects several subfields of a field into a dict.
 
+    If there are multiple fields with the tag, the last one that has any of the subfields wins.
+    :param groups: fields of a marc record, as returned by extract_all()
+    :param tag: tag of the field
+    :param mapping: pairs of subfield code and the key it gets in the dict
+    :return: dict of the subfields found, or None if there are none
+    """
 
-def get_footnote(records):
-    footnote = None
-    for field in records.get_fields('500'):
-        if 'a' in field:
-            footnote = field['a'].encode('utf-8')
+    for field in reversed(groups.get(tag, [])):
+        res = {key: field[code] for code, key in mapping if code in field}
+        if res:
+            return res
+    return None
 
-    return footnote
 
+def get_description(groups):
+    return __get_subfield_dict(groups, '245', (
+        ('a', 'title'),
+        ('c', 'author')
+    ))
 
-def get_bibliographical_info(records):
-    bibliographical_info = None
-    for field in records.get_fields('510'):
-        if 'a' in field:
-            bibliographical_info = {
-                'reference': field['a'].encode('utf-8')
-            }
 
-        if 'i' in field:
-            if bibliographical_info is not None:
-                bibliographical_info.update({
-                    'type': field['i'].encode('utf-8')
-                })
-            else:
-                bibliographical_info = {
-                    'type': field['i'].encode('utf-8')
-                }
+def get_creation_form(groups):
+    return __get_last_subfield(groups, '250', 'a')
 
-    return bibliographical_info
 
+def get_creation_place(groups):
+    return __get_subfield_dict(groups, '751', (
+        ('a', 'place'),
+        ('0', 'gnd')
+    ))
 
-def get_content_info(records):
-    content_info = None
-    for field in records.get_fields('520'):
-        if 'a' in field:
-            content_info = field['a'].encode('utf-8')
 
-    return content_info
+def get_physical_description(groups):
+    return __get_subfield_dict(groups, '300', (
+        ('a', 'amount'),
+        ('c', 'format')
+    ))
 
 
-def get_accompanying_material(records):
-    accompanying_material = None
-    for field in records.get_fields('525'):
-        if 'a' in field:
-            accompanying_material = field['a']
+def get_footnote(groups):
+    return __get_last_subfield(groups, '500', 'a')
 
-    return accompanying_material
 
+def get_bibliographical_info(groups):
+    return __get_subfield_dict(groups, '510', (
+        ('a', 'reference'),
+        ('i', 'type')
+    ))
 
-def get_reproduction_info(records):
-    reproduction_info = None
-    for field in records.get_fields('533'):
-        if 'a' in field:
-            reproduction_info = {
-                'type': field['a'].encode('utf-8')
-            }
 
-        if 'b' in field:
-            if reproduction_info is not None:
-                reproduction_info.update({
-                    'place': field['b'].encode('utf-8')
-                })
-            else:
-                reproduction_info = {
-                    'place': field['b'].encode('utf-8')
-                }
-
-        if 'c' in field:
-            if reproduction_info is not None:
-                reproduction_info.update({
-                    'institution': field['c'].encode('utf-8')
-                })
-            else:
-                reproduction_info = {
-                    'institution': field['c'].encode('utf-8')
-                }
-
-        if 'd' in field:
-            if reproduction_info is not None:
-                reproduction_info.update({
-                    'year': field['d'].encode('utf-8')
-                })
-            else:
-                reproduction_info = {
-                    'year': field['d'].encode('utf-8')
-                }
-
-        if 'n' in field:
-            if reproduction_info is not None:
-                reproduction_info.update({
-                    'additional': field['n'].encode('utf-8')
-                })
-            else:
-                reproduction_info = {
-                    'additional': field['n'].encode('utf-8')
-                }
+def get_content_info(groups):
+    return __get_last_subfield(groups, '520', 'a')
 
-    return reproduction_info
 
+def get_accompanying_material(groups):
+    return __get_last_subfield(groups, '525', 'a')
 
-def get_language(records):
-    language = None
-    for field in records.get_fields('546'):
-        if 'a' in field:
-            language = field['a'].encode('utf-8')
 
-    return language
+def get_reproduction_info(groups):
+    return __get_subfield_dict(groups, '533', (
+        ('a', 'type'),
+        ('b', 'place'),
+        ('c', 'institution'),
+        ('d', 'year'),
+        ('n', 'additional')
+    ))
 
 
-def get_bernoulli_work_reference(records):
-    bernoulli_work_reference = None
-    for field in records.get_fields('596'):
-        if 'a' in field:
-            bernoulli_work_reference = field['a']
+def get_language(groups):
+    return __get_last_subfield(groups, '546', 'a')
 
-    return bernoulli_work_reference
 
+def get_bernoulli_work_reference(groups):
+    return __get_last_subfield(groups, '596', 'a')
 
-def get_emanuscript_link(records):
-    emanuscript_link = None
-    for field in records.get_fields('856'):
-        if 'u' in field:
-            emanuscript_link = field['u']
 
-    return emanuscript_link
+def get_emanuscript_link(groups):
+    return __get_last_subfield(groups, '856', 'u')
@@ -9,7 +9,11 @@ and eventually have a dummy XML file created.
 """
 
 import os
+from collections import OrderedDict
 from lxml import etree
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import cPickle as pickle
 import random
 import sys
 
@@ -18,6 +22,11 @@ force_all = False
 is_test = False
 testable = None
 
+xml_dir = "data/input/xml/"
+
+# the progress counter is only updated every this many files, to save on writes to the console
+progress_interval = 50
+
 
 def get_sys_nos_to_work_with(force, test, testable_no):
     """
@@ -61,21 +70,6 @@ def get_sys_nos_to_work_with(force, test, testable_no):
     return list_for_dummies
 
 
-def crop_list(lst):
-    """
-    strips all strings in a list.
-
-    Iterates over a list of strings and performs strip() on each one.
-    :param lst: the list of string with potential heading/tailing whitespaces
-    :return: a list with the cropped strings
-    """
-
-    out = []
-    for l in lst:
-        out.append(l.strip())
-    return out
-
-
 def get_all_sys_nos():
     """
     reads all system numbers from the file `data/input/all_numbers.txt`
@@ -84,10 +78,8 @@ def get_all_sys_nos():
     """
 
     print("loading 'all numbers'...")
-    with open("data/input/all_numbers.txt") as f:
-        res = f.readlines()
+    res = __load_cached("data/input/all_numbers.txt", "data/tmp/all_numbers.pkl", list)
     print("found numbers: " + str(len(res)))
-    res = crop_list(res)
 #    print(res)
     return res
 
@@ -118,7 +110,6 @@ def get_used_sys_no_list():
             used_nos = grab_used_nos()
             __write_used_nos(used_nos)
 
-    used_nos = crop_list(used_nos)
     print("Got Already Used System Numbers now.\n")
 #    print(used_nos)
 
@@ -135,7 +126,8 @@ def grab_used_nos():
     :return: Returns a list of system numbers for each XML file found.
     """
 
-    files = os.listdir("data/input/xml")
+    # skip anything that is not a letter, so no time is wasted trying to parse it
+    files = [f for f in os.listdir(xml_dir) if f.endswith(".xml")]
     print("found {} files.".format(len(files)))
     #print("files: {}".format(files))
 
@@ -143,13 +135,23 @@ def grab_used_nos():
     res = []
     i = 1
     max = len(files)+1
-    for f in files:
-        sys.stdout.write("\r{} of {}".format(i, max))
-        sys.stdout.flush()
-        i = i + 1
-        # print(f)
-        sys_no = get_by_name(f)
-        res.append(sys_no)
+    # lxml releases the GIL while parsing, so the files can be read in parallel
+    pool = ThreadPool(cpu_count())
+    try:
+        for sys_no in pool.imap(get_by_name, files):
+            if i % progress_interval == 0 or i == len(files):
+                sys.stdout.write("\r{} of {}".format(i, max))
+                sys.stdout.flush()
+            i = i + 1
+            res.append(sys_no)
+    except:
+        # don't keep reading files, when the run fails or is interrupted
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
 
     print("\ngot {} numbers to work with.".format(len(res)))
 #    print("Result: ")
@@ -165,21 +167,22 @@ def get_by_name(name):
     :return: system number of the xml file.
     """
 
-    prefix = "data/input/xml/"
     res = ""
     try:
-        root = etree.parse(prefix + name, etree.XMLParser(load_dtd=True)).getroot()
-        res = root.get("catalogue_id")
-    except OSError:
+        with open(xml_dir + name, "rb") as f:
+            # only the root element is needed, so stop parsing right after its start tag
+            for _, root in etree.iterparse(f, events=('start',), load_dtd=False, resolve_entities=False):
+                # stripped right here, so the numbers need no further cleaning up later on
+                res = root.get("catalogue_id", "").strip()
+                break
+    except (IOError, OSError, etree.XMLSyntaxError):
         print("Could not read File: " + name + "\n")
     return res
 
 
 def __read_used_nos():
     print("Reading used System Numbers from File...")
-    with open("data/tmp/existing_numbers.txt", "r") as f:
-        res = f.readlines()
-    return res
+    return __load_cached("data/tmp/existing_numbers.txt", "data/tmp/existing_numbers.pkl", frozenset)
 
 
 def __write_used_nos(used_nos):
@@ -189,6 +192,38 @@ def __write_used_nos(used_nos):
             f.write(l + "\n")
 
 
+def __load_cached(txt_path, pkl_path, container):
+    """
+    Reads the system numbers from a text file, using a pickled copy of them where possible.
+
+    The pickle stores size and modification time of the text file it was made from.
+    If the text file has changed since, it is read again and the pickle is renewed.
+    :param txt_path: path of the text file, containing one system number per line
+    :param pkl_path: path of the pickled copy
+    :param container: type to return the numbers in (e.g. list or frozenset)
+    :return: the system numbers from the text file
+    """
+
+    stat = os.stat(txt_path)
+    key = (stat.st_size, stat.st_mtime)
+
+    if os.path.isfile(pkl_path):
+        try:
+            with open(pkl_path, "rb") as f:
+                cached_key, res = pickle.load(f)
+            if cached_key == key:
+                return res
+        except (pickle.UnpicklingError, EOFError, ImportError, AttributeError, ValueError):
+            print("Could not load pickled numbers: " + pkl_path + "\n")
+
+    with open(txt_path) as f:
+        # split() strips the numbers and skips blank lines
+        res = container(f.read().split())
+    with open(pkl_path, "wb") as f:
+        pickle.dump((key, res), f, pickle.HIGHEST_PROTOCOL)
+    return res
+
+
 def get_list_of_numbers_to_work_with(all_nos, used):
     """
     creates a list of all numbers contained in the all- list but not in the used-list
@@ -198,10 +233,9 @@ def get_list_of_numbers_to_work_with(all_nos, used):
     :return: a list containing all numbers in `all_nos` but not in `used`.
     """
 
-    res = []
-    for no in all_nos:
-        if no not in used:
-            res.append(no)
+    # a set makes the lookups constant time; OrderedDict drops duplicates while keeping the order of `all_nos`
+    used_set = set(used)
+    res = [no for no in OrderedDict.fromkeys(all_nos) if no not in used_set]
 
     if is_test:
         test_res = []
@@ -214,5 +248,4 @@ def get_list_of_numbers_to_work_with(all_nos, used):
             test_res.append(testable)
             return test_res
 
-    res = crop_list(res)
     return res